@@ -10,6 +10,13 @@ import json
 import hashlib
 import hmac
 import time
+import threading
+import logging
+import functools
+import socket
+
+
+REQUEST_TIMEOUT = 10  # seconds, hung request must not block other queries waiting on the connection lock
 
 
 class ExmoAPI:
@@ -18,37 +25,91 @@ class ExmoAPI:
         self.API_VERSION = API_VERSION
         self.API_KEY = API_KEY
         self.API_SECRET = bytes(API_SECRET, encoding='utf-8')
+        # key is fixed for the instance, so inner/outer padded key states are derived once and copied per request
+        self._hmac: hmac.HMAC = hmac.new(key=self.API_SECRET, digestmod=hashlib.sha512)
+
+        # single keep-alive connection reused across queries, guarded as it's shared between threads
+        self._conn: http.client.HTTPSConnection = None
+        self._conn_lock = threading.Lock()
+        self._nonce = 0
 
-    def sha512(self, data: str):
-        h: hmac.HMAC = hmac.new(key=self.API_SECRET, digestmod=hashlib.sha512)
-        h.update(data.encode('utf-8'))
+    def sha512(self, data: bytes):
+        h: hmac.HMAC = self._hmac.copy()
+        h.update(data)
         return h.hexdigest()
 
     def api_query(self, api_method: str, params: dict = {}) -> object:
-        params['nonce'] = int(round(time.time() * 1000))
-        params = urllib.parse.urlencode(params)
+        with self._conn_lock:
+            # nonce is issued under the same lock the request is sent with, so exchange always gets them increasing
+            body = encode_params(tuple(params.items())) + b'nonce=%d' % self._next_nonce()
 
-        sign = self.sha512(params)
-        headers = {
-            "Content-type": "application/x-www-form-urlencoded",
-            "Key": self.API_KEY,
-            "Sign": sign
-        }
-        conn = http.client.HTTPSConnection(self.API_URL)
-        conn.request("POST", "/" + self.API_VERSION + "/" + api_method, params, headers)
-        response = conn.getresponse().read()
-
-        conn.close()
+            sign = self.sha512(body)
+            headers = {
+                "Content-type": "application/x-www-form-urlencoded",
+                "Key": self.API_KEY,
+                "Sign": sign
+            }
+            response = self._post("/" + self.API_VERSION + "/" + api_method, body, headers)
 
         try:
-            obj = json.loads(response.decode('utf-8'))
-            if 'error' in obj and obj['error']:
-                # print(obj['error'])
-                raise ExmoError(str(obj['error']), obj)
+            obj = json.loads(response)  # parses utf-8 bytes as is, no intermediate str copy
+            # some methods respond with a list (e.g. currency), only dicts carry an error
+            err = obj.get('error') if isinstance(obj, dict) else None
+            if err:
+                raise ExmoError(str(err), obj)
             return obj
         except json.decoder.JSONDecodeError:
             raise ExmoError('Error while parsing response:', response)
 
+    def _next_nonce(self) -> int:
+        # unix time in ms, strictly increasing even for several requests within the same ms
+        now = time.time_ns() // 1000000
+        self._nonce = now if now > self._nonce else self._nonce + 1
+        return self._nonce
+
+    def _post(self, url: str, body: bytes, headers: dict) -> bytes:
+        # reuse the open connection, reconnect and retry once if the server has dropped it meanwhile
+        for attempt in range(2):
+            if not self._conn:
+                self._conn = http.client.HTTPSConnection(self.API_URL, timeout=REQUEST_TIMEOUT)
+            try:
+                self._conn.request("POST", url, body, headers)
+                return self._conn.getresponse().read()
+            except (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionError, socket.timeout):
+                self.close()
+                if attempt:
+                    raise
+            except Exception:
+                self.close()
+                raise
+
+    def connect(self):
+        # opens connection ahead of first query, so TCP and TLS handshakes are not paid on it
+        with self._conn_lock:
+            if not self._conn:
+                self._conn = http.client.HTTPSConnection(self.API_URL, timeout=REQUEST_TIMEOUT)
+                try:
+                    self._conn.connect()
+                except Exception:
+                    self.close()
+                    raise
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+
+@functools.lru_cache(maxsize=128)
+def encode_params(params: tuple) -> bytes:
+    """
+    Url encodes request params to the body prefix the nonce is appended to, most of queries repeat the same params
+    (often none at all), so encoded prefixes are cached
+    :param params: tuple of (name, value) pairs
+    :return: bytes like b'pair=BTC_USD&limit=100&' or b'' for no params
+    """
+    return urllib.parse.urlencode(params).encode('utf-8') + b'&' if params else b''
+
 
 class ExmoError(Exception):
     """
@@ -57,6 +118,20 @@ class ExmoError(Exception):
     pass
 
 
+def check_sha512_backend():
+    # request signing goes through sha512 on every call, OpenSSL picks SHA-NI/AVX2 implementation where CPU has it,
+    # while python built without OpenSSL falls back to builtin _sha512 which is several times slower
+    if hashlib.sha512.__module__ != '_hashlib':
+        logging.getLogger(__name__).warning('hashlib sha512 is not backed by OpenSSL, request signing will be slow. '
+                                            'Use python linked against OpenSSL 1.1.1+')
+
+
+check_sha512_backend()
+
+# Clean up namespace
+del check_sha512_backend
+
+
 if __name__ == '__main__':
     # Example
     ExmoAPI_instance = ExmoAPI(api_key, api_secret)
@@ -10,10 +10,22 @@ Donate BTC: 16KqCc4zxEWf7CaerWNZdGYwyuU33qDzCv
 
 from datetime import datetime, timezone
 from decimal import Decimal
-from typing import Dict
+from typing import Dict, Iterable
 import logging
+import types
+from operator import itemgetter
 from typing import NamedTuple
 from exchange_apis.exmo_api import ExmoError
+from exchanges.file_cache import FileCache
+
+CACHE_DIR = './cache'
+CACHE_TTL = 86400  # pair settings and currencies change rarely, refetch them once a day
+
+FEES = types.MappingProxyType({'maker': Decimal('0.002'), 'taker': Decimal('0.002')})  # plain fee 0.2% per deal
+MARKET_PRICE = Decimal('0')  # price is ignored by exchange for market orders
+
+# Ticker fields in exmo ticker response, picked all at once in the order of Ticker fields
+TICKER_FIELDS = itemgetter('high', 'low', 'avg', 'vol', 'vol_curr', 'last_trade', 'buy_price', 'sell_price', 'updated')
 
 
 class Ticker(NamedTuple):
@@ -29,25 +41,24 @@ class Ticker(NamedTuple):
     updated: datetime
 
     def __str__(self):
-        return "High: " + str(self.high) + \
-               ", low: " + str(self.low) + \
-               ", avg: " + str(self.avg) + \
-               ", vol: " + str(self.vol) + \
-               ", vol_curr: " + str(self.vol_curr) + \
-               ", last_trade: " + str(self.last_trade) + \
-               ", buy_price: " + str(self.buy_price) + \
-               ", sell_price: " + str(self.sell_price) + \
-               ", updated: " + str(self.updated)
+        return f"High: {self.high}, low: {self.low}, avg: {self.avg}, vol: {self.vol}, vol_curr: {self.vol_curr}, " \
+               f"last_trade: {self.last_trade}, buy_price: {self.buy_price}, sell_price: {self.sell_price}, " \
+               f"updated: {self.updated}"
 
 
 # TODO consider CCXT lib, extract exchange interface and make pluggable exchanges
 class ExmoExchange:
 
-    def __init__(self, exmo_api, logger, ):
+    def __init__(self, exmo_api, logger, cache: FileCache = None):
         self.exmo_api = exmo_api
+        self.cache = cache if cache else FileCache(CACHE_DIR, CACHE_TTL)
         self.logger = logger.getChild(__name__) if logger else logging.getLogger(__name__)
         self.pair_settings = {}
-        self.fees = {'maker': Decimal('0.002'), 'taker': Decimal('0.002')}  # plain fee 0.02% per deal
+        self._tickers = {}  # last raw ticker and Ticker built from it by pair, to skip rebuilding unchanged ones
+        self.fees = FEES
+
+    def warmup_connection(self):
+        self.exmo_api.connect()
 
     def place_limit_buy(self, pair: str, quantity: Decimal, price: Decimal) -> int:
         return self.place_order(pair, quantity, price, 'buy')
@@ -56,16 +67,16 @@ class ExmoExchange:
         return self.place_order(pair, quantity, price, 'sell')
 
     def place_market_buy(self, pair: str, quantity: Decimal) -> int:
-        return self.place_order(pair, quantity, Decimal('0'), 'market_buy')
+        return self.place_order(pair, quantity, MARKET_PRICE, 'market_buy')
 
     def place_market_sell(self, pair: str, quantity: Decimal) -> int:
-        return self.place_order(pair, quantity, Decimal('0'), 'market_sell')
+        return self.place_order(pair, quantity, MARKET_PRICE, 'market_sell')
 
     def place_market_buy_total(self, pair: str, amount: Decimal) -> int:
-        return self.place_order(pair, amount, Decimal('0'), 'market_buy_total')
+        return self.place_order(pair, amount, MARKET_PRICE, 'market_buy_total')
 
     def place_market_sell_total(self, pair: str, amount: Decimal) -> int:
-        return self.place_order(pair, amount, Decimal('0'), 'market_sell_total')
+        return self.place_order(pair, amount, MARKET_PRICE, 'market_sell_total')
 
     def place_order(self, pair: str, quantity: Decimal, price: Decimal, ord_type: str) -> int:
         """
@@ -102,7 +113,7 @@ class ExmoExchange:
 
             # result['error'] is handled in exmo_api, will get an exception with error msg
             order_id = int(result['order_id'])
-            self.logger.info('Order placed: %s:%s', str(order_id), params)
+            self.logger.info('Order placed: %s:%s', order_id, params)
             return order_id
         except Exception as e:
             self.logger.error(e.args)
@@ -115,7 +126,7 @@ class ExmoExchange:
         response = self.exmo_api.api_query("order_cancel", params)
 
         if not response['result']:
-            msg = "Error canceling order " + order_id + ", msg: " + response['error']
+            msg = "Error canceling order {}, msg: {}".format(order_id, response.get('error'))
             self.logger.error(msg)
             raise ExmoError(msg, order_id)
 
@@ -126,7 +137,7 @@ class ExmoExchange:
         :return: {
                   "type": "buy",            // type – type of order
                   "in_currency": "BTC",     // in_currency – incoming currency
-                  "in_amount": "1",         // in_amount - amount of incoming currency
+                  "in_amount": "1",         // in_amount - amount of incoming currency, returned as Decimal
                   "out_currency": "USD",    // out_currency - outcoming currency
                   "out_amount": "100",      // out_amount - amount of outcoming currency
                   "trades": [               // trades - deals array where the values mean the following:
@@ -147,6 +158,9 @@ class ExmoExchange:
 
         params = {"order_id": order_id}
         response = self.exmo_api.api_query("order_trades", params)
+        if response and 'in_amount' in response:
+            # parsed once here, via str so that amount sent as json number doesn't carry float representation error
+            response['in_amount'] = Decimal(str(response['in_amount']))
         return response
 
     def get_user_trades(self, pair: str, offset: int = 0, limit: int = 100):
@@ -216,45 +230,27 @@ class ExmoExchange:
             response = self.exmo_api.api_query('ticker')
 
             if pair and response[pair]:
-                _t = response[pair]
-                ticker = Ticker(
-                    Decimal(_t["high"]),
-                    Decimal(_t["low"]),
-                    Decimal(_t["avg"]),
-                    Decimal(_t["vol"]),
-                    Decimal(_t["vol_curr"]),
-
-                    Decimal(_t["last_trade"]),
-                    Decimal(_t["buy_price"]),
-                    Decimal(_t["sell_price"]),
-                    from_timestamp(_t["updated"])
-                )
+                ticker = to_ticker(response[pair])
 
                 self.logger.debug("Ticker received - %s",  ticker)
                 return ticker
             else:
-                for pair in response:
-                    _t = response[pair]
-                    ticker = Ticker(
-                        Decimal(_t["high"]),
-                        Decimal(_t["low"]),
-                        Decimal(_t["avg"]),
-                        Decimal(_t["vol"]),
-                        Decimal(_t["vol_curr"]),
-
-                        Decimal(_t["last_trade"]),
-                        Decimal(_t["buy_price"]),
-                        Decimal(_t["sell_price"]),
-                        from_timestamp(_t["updated"])
-                    )
-                    response[pair] = ticker
-
-                return response
+                return {p: self._to_cached_ticker(p, t) for p, t in response.items()}
 
         except BaseException as e:
             self.logger.error("Error getting ticker: %s", e, exc_info=1)
             raise e
 
+    def _to_cached_ticker(self, pair: str, raw: Dict) -> Ticker:
+        # most of pairs are not traded between two polls, reuse their Ticker instead of parsing Decimals again
+        last = self._tickers.get(pair)
+        if last and last[0] == raw:
+            return last[1]
+
+        ticker = to_ticker(raw)
+        self._tickers[pair] = (raw, ticker)
+        return ticker
+
     def get_order_book(self, pair: str, limit: int = 100) -> Dict:
         """
         The book of current orders on the currency pair
@@ -291,6 +287,15 @@ class ExmoExchange:
         response = self.exmo_api.api_query("order_book", params)
         return response
 
+    def get_order_book_batch(self, pairs: Iterable[str], limit: int = 100) -> Dict:
+        """
+        Order books for several currency pairs fetched with one request
+        :param pairs: currency pairs (example: ['BTC_USD', 'ETH_BTC', 'ETH_USD'])
+        :param limit: the number of displayed positions per pair (default: 100, max: 1000)
+        :return: dict of order books by pair, same as get_order_book
+        """
+        return self.get_order_book(','.join(pairs), limit)
+
     def get_markets(self):
         """
         :return: list of currency pairs available for trading on Exmo
@@ -309,8 +314,8 @@ class ExmoExchange:
         :return:
                 ["USD","EUR","RUB","BTC","DOGE","LTC"] 
         """
-        response = self.exmo_api.api_query('currency')
-        self.logger.debug('Currencies received: %s', str(response))
+        response = self._cached_query('currency')
+        self.logger.debug('Currencies received: %s', response)
         return response
 
     def _get_pair_settings(self):
@@ -335,11 +340,30 @@ class ExmoExchange:
             min_amount - minimum total sum for the order
             max_amount - maximum total sum for the order
         """
-        response = self.exmo_api.api_query('pair_settings')
-        self.logger.debug('Pair settings received %s', str(response))
+        response = self._cached_query('pair_settings')
+        self.logger.debug('Pair settings received %s', response)
+        return response
+
+    def _cached_query(self, api_method: str):
+        # for rarely changing data, look up the file cache first to save a round trip to exchange
+        key = 'exmo_' + api_method
+        response = self.cache.get(key)
+        if response is None:
+            response = self.exmo_api.api_query(api_method)
+            self.cache.set(key, response)
         return response
 
 
+def to_ticker(t: Dict) -> Ticker:
+    """
+    Util method to build Ticker from the raw exmo ticker fields, prices and volumes are converted to Decimal
+    :param t: dict with ticker fields as received from exchange
+    :return: Ticker
+    """
+    *values, updated = TICKER_FIELDS(t)
+    return Ticker(*map(Decimal, values), from_timestamp(updated))
+
+
 def from_timestamp(s):
     """
     Util method to convert from unix time to normal datetime representation
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+triarbot: Simple triangular arbitrage bot
+Python 3+
+(C) 2018 SurgeonY, Planet Earth
+
+Donate ETH: 0xFA745708C435300058278631429cA910AE175d52
+Donate BTC: 16KqCc4zxEWf7CaerWNZdGYwyuU33qDzCv
+"""
+
+import json
+import os
+import pathlib
+import time
+
+
+class FileCache:
+    """
+    Simple file backed cache for rarely changing exchange data, like pair settings or currencies list.
+    Every key is stored in its own json file, entries older than ttl seconds are considered expired.
+    """
+
+    def __init__(self, base_dir: str = './cache', ttl: int = 86400):
+        self.base_dir = pathlib.Path(base_dir)
+        self.ttl = ttl
+        self.base_dir.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key: str):
+        """
+        :param key: cache key, should be usable as a file name
+        :return: cached object or None if missing or expired
+        """
+        path = self._path(key)
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                return None
+            with path.open('rb') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key: str, obj):
+        # write to a temp file and swap it in, so readers never see a partially written entry
+        path = self._path(key)
+        tmp_path = path.with_suffix('.tmp')
+        with tmp_path.open('w') as f:
+            json.dump(obj, f)
+        os.replace(tmp_path, path)
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.base_dir / (key + '.json')
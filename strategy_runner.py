@@ -32,10 +32,12 @@ class StrategyRunner(Thread):
         self.logger.info('Thread #%s:%s started', self.ident, self.name)
         self.strategy.start()
 
-        while not self.shutdown_flag.is_set():
-            # main event loop
+        next_update = time.monotonic() + self.interval
+        # main event loop, waiting on the flag instead of sleeping lets shutdown interrupt the wait immediately
+        while not self.shutdown_flag.wait(max(0.0, next_update - time.monotonic())):
+            # interval is counted from the start of update, time spent in exchange calls is not added on top of it
+            next_update = time.monotonic() + self.interval
             try:
-                time.sleep(self.interval)
                 self.strategy.update()
             except OSError as e:
                 self.logger.error('OS Error: %s', e, exc_info=1)
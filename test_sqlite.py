@@ -12,13 +12,19 @@ import sqlite3
 import datetime
 
 con = sqlite3.connect(":memory:", detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+con.execute("PRAGMA journal_mode=WAL")  # no effect for :memory:, but that's how file dbs should be opened
+con.execute("PRAGMA synchronous=NORMAL")
+con.execute("PRAGMA temp_store=MEMORY")
 cur = con.cursor()
 cur.execute("create table test(d date, ts timestamp)")
 
 today = datetime.date.today()
 now = datetime.datetime.now()
 
-cur.execute("insert into test(d, ts) values (?, ?)", (today, now))
+# insert rows in batch, single statement execution and commit for all of them
+rows = [(today, now), (today - datetime.timedelta(days=1), now - datetime.timedelta(days=1))]
+cur.executemany("insert into test(d, ts) values (?, ?)", rows)
+con.commit()
 cur.execute("select d, ts from test")
 row = cur.fetchone()
 print(today, "=>", row[0], type(row[0]))
@@ -14,6 +14,7 @@ import time
 from exchange_apis import exmo_api
 import logging.handlers
 import pathlib
+import queue
 # import yaml
 from ruamel.yaml import YAML
 from argparse import ArgumentParser
@@ -28,13 +29,16 @@ pathlib.Path('./logs').mkdir(parents=True, exist_ok=True)
 
 log = logging.getLogger('triarbot')
 log.setLevel(logging.INFO)
-handler = logging.StreamHandler(sys.stdout)
-handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s - %(message)s'))
-log.addHandler(handler)
+stream_handler = logging.StreamHandler(sys.stdout)
+stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s - %(message)s'))
 
-handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, maxBytes=2096000, backupCount=5)
-handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s - %(message)s'))
-log.addHandler(handler)
+file_handler = logging.handlers.RotatingFileHandler(LOG_FILENAME, maxBytes=2096000, backupCount=5)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s - %(message)s'))
+
+# records are only enqueued by the logging threads, console and file writes happen in the listener's thread
+log_queue = queue.SimpleQueue()
+log.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, stream_handler, file_handler, respect_handler_level=True)
 
 arg_parser = ArgumentParser(description="Simple triangular arbitrage trading bot")
 arg_parser.add_argument("-s", "--secrets", dest="SECRETS_PATH", default="secrets_conf_template.yml",
@@ -42,7 +46,7 @@ arg_parser.add_argument("-s", "--secrets", dest="SECRETS_PATH", default="secrets
 arg_parser.add_argument("-c", "--config", dest="CONFIG_PATH", default="config.yml",
                         help="path to a config file with bot parameters", metavar="FILE")
 
-yaml = YAML(typ='safe')   # default, if not specfied, is 'rt' (round-trip)
+yaml = YAML(typ='safe')   # default, if not specfied, is 'rt' (round-trip), safe loader uses libyaml C ext if installed
 
 
 def run():
@@ -50,8 +54,10 @@ def run():
 
     args = arg_parser.parse_args()
 
-    secrets = yaml.load(open(args.SECRETS_PATH))
+    with open(args.SECRETS_PATH) as f:
+        secrets = yaml.load(f)
 
+    global api_instance
     api_instance = exmo_api.ExmoAPI(secrets["exmo"]["API_KEY"], secrets["exmo"]["API_SECRET"],
                                     secrets["exmo"]["API_URL"])
     global exmo_exchange
@@ -93,15 +99,9 @@ def run():
                 account = get_account_info()
                 log.info("User account as on: %s", account['server_date'])
 
-                s = ""
-                for curr in account['balances']:
-                    if account['balances'][curr] > 0:
-                        s = s + curr + "=" + str(account['balances'][curr]) + ", "
+                s = ", ".join(curr + "=" + str(amount) for curr, amount in account['balances'].items() if amount > 0)
                 log.info("--Cash balance: %s", s)
-                s = ""
-                for curr in account['reserved']:
-                    if account['reserved'][curr] > 0:
-                        s = s + curr + "=" + str(account['reserved'][curr]) + ", "
+                s = ", ".join(curr + "=" + str(amount) for curr, amount in account['reserved'].items() if amount > 0)
                 log.info("--In orders: %s", s)
 
                 continue
@@ -117,10 +117,7 @@ def run():
 
             if oper == 5:
                 markets = exmo_exchange.get_markets()
-                s = ''
-                for pair in markets:
-                    s += pair + ', '
-                log.info('Markets available %s: %s', len(markets), s)
+                log.info('Markets available %s: %s', len(markets), ', '.join(markets))
                 continue
 
             if oper == 6:
@@ -142,6 +139,9 @@ def run():
 
     except BaseException as e:
         log.error("Error processing: %s", e, exc_info=1)
+        # e.g. Ctrl-C, runner is stopped so strategy shuts down cleanly, flushing its DB writes
+        if 'tri_arb_runner' in globals():
+            shutdown_tri_arb()
 
     log.info("Stopping")
     return
@@ -168,7 +168,6 @@ def cancel_all_orders():
 
 def get_account_info():
     try:
-        api_instance = exmo_api.ExmoAPI(API_KEY, API_SECRET)
         response = api_instance.api_query("user_info")
 
         response['server_date'] = from_timestamp(response['server_date'])
@@ -199,8 +198,7 @@ def get_open_orders():
     """
 
     try:
-        api_instance = exmo_api.ExmoAPI(API_KEY, API_SECRET)
-        orders_pairs: Dict = api_instance.api_query("user_open_orders")
+        orders_pairs: Dict = exmo_exchange.get_user_open_orders()
 
         result = []
         # orders = orders[pair]
@@ -218,4 +216,8 @@ def get_open_orders():
 
 
 if __name__ == '__main__':
-    run()
+    log_listener.start()
+    try:
+        run()
+    finally:
+        log_listener.stop()  # flushes queued records
@@ -9,7 +9,7 @@ Donate BTC: 16KqCc4zxEWf7CaerWNZdGYwyuU33qDzCv
 """
 
 import logging
-from typing import Dict, Callable, Tuple, List
+from typing import Dict, Callable, Tuple, List, FrozenSet
 from decimal import Decimal
 import abc
 from exchanges.exmo_exchange import Ticker
@@ -27,7 +27,7 @@ class TriangularArbitrageIndicator:
     """
 
     def __init__(self, quote_curr: str, currencies: List, fees: Dict[str, Decimal], order_type: OrderType,
-                 gain_min_limit: Decimal, logger: logging.Logger):
+                 gain_min_limit: Decimal, logger: logging.Logger, arb_calculator: 'AbstractArbCalculator' = None):
         self.quote_curr = quote_curr  # curr against which P&L is tracked, and tri arb loops open and close
         self.fees = fees  # get from exchange (0.2% on exmo)
         self.order_type = order_type
@@ -35,81 +35,103 @@ class TriangularArbitrageIndicator:
         self.logger = logger if logger else logging.getLogger(__name__)
 
         self._signal_handler: Callable[[PairAndRate, PairAndRate, PairAndRate, Decimal, OrderType], None] = None
-        self.arb_opps: Dict[str, Tuple[PairAndRate, PairAndRate, PairAndRate, Decimal]] = {}
         # list of currencies between which we're doing arbitrage given available markets/pairs on exchange
         # remove xem, smart, qtum, neo
         # TODO implement currency selection based on stats 24h volume, take most liquid e.g those which Volume>20 BTC
 
         self.trading_currencies = currencies
-
-        fee_type = 'maker' if order_type == OrderType.MARKET else 'taker'
-        self.arb_calculator: AbstractArbCalculator = MarketOrderArbCalculator(fees[fee_type]) \
-            if order_type == OrderType.MARKET else LimitOrderArbCalculator(fees[fee_type], Decimal('0.0005'))
+        self._other_currencies = tuple(c for c in currencies if c != quote_curr)  # candidates for curr1 and curr2
+        # arbitrage loops available on exchange, rebuilt on markets change, as calculator leg ids: curr1->quote_curr
+        # leg with curr2->curr1 and quote_curr->curr2 legs of all curr2 closing the loop
+        self._triangles: List[Tuple[int, List[Tuple[int, int]]]] = []
+        self._markets: FrozenSet[str] = frozenset()
+
+        # calculator can be shared by indicators on different quote currencies, so legs common for their loops
+        # are calculated only once per tickers update
+        fee_type = get_fee_type(order_type)
+        self.arb_calculator: AbstractArbCalculator = arb_calculator if arb_calculator \
+            else make_arb_calculator(order_type, fees)
 
         self.logger.info('Starting TriArb Indicator on %s, %s orders, fees: %s=%s', quote_curr, order_type, fee_type,
                          fees[fee_type])
 
     def update(self, tickers: Dict[str, Ticker]):
         self.arb_calculator.set_tickers(tickers)
+        if tickers.keys() != self._markets:
+            self._build_triangles(tickers)
+
         max_gain = Decimal('0')
-        max_path = ''
+        best_opp: Tuple[PairAndRate, PairAndRate, PairAndRate, Decimal] = None  # only max gain one is signaled
 
         # determine arbitrage opportunities
-        # iterate over all currencies and check all loops starting from and ending with the quote curr
-        # via two other currencies
-        for curr1 in self.trading_currencies:
-            if curr1 == self.quote_curr:  # skip e.g. USD
-                continue
-
+        # iterate over prebuilt loops starting from and ending with the quote curr via two other currencies,
+        # names used in the inner loop are bound to locals to save attribute lookups per loop
+        get_leg = self.arb_calculator.get_leg
+        debug = self.logger.isEnabledFor(logging.DEBUG)  # path and rates of every profitable loop are logged only
+        for curr1_quote_id, legs in self._triangles:
             # First: buy curr1 with quote_curr (or sell quote_curr for curr1)
-            curr1_quote = self.arb_calculator.get_pair_and_rate(curr1, self.quote_curr)
-            if not curr1_quote:
-                continue
-
-            for curr2 in self.trading_currencies:
-                if curr2 == self.quote_curr or curr2 == curr1:  # e.g. skip USD and BTC
-                    continue
+            curr1_quote = get_leg(curr1_quote_id)
+            quote_per_curr1 = 1 / curr1_quote.calc_rate  # loop invariant for all curr2
 
+            for curr2_curr1_id, quote_curr2_id in legs:
                 # Second: buy curr2 for curr1 (or sell curr1 for curr2)
-                curr2_curr1 = self.arb_calculator.get_pair_and_rate(curr2, curr1)
-                if not curr2_curr1:
-                    continue
+                curr2_curr1 = get_leg(curr2_curr1_id)
 
                 # Third: selling curr2 for quote curr... (or equivalent is buying our quote curr for curr2)
-                quote_curr2 = self.arb_calculator.get_pair_and_rate(self.quote_curr, curr2)
-                if not quote_curr2:
-                    continue
+                quote_curr2 = get_leg(quote_curr2_id)
 
-                gain = curr2_curr1.calc_rate * quote_curr2.calc_rate - 1 / curr1_quote.calc_rate
+                gain = curr2_curr1.calc_rate * quote_curr2.calc_rate - quote_per_curr1
 
                 if gain > 0:
-                    path = curr1_quote.pair + '>' + curr2_curr1.pair + '>' + quote_curr2.pair
-                    self.arb_opps[path] = (curr1_quote, curr2_curr1, quote_curr2, gain)  # consider named tuple dto?
-
-                    self.logger.debug('%s orders, gain: %s, path: %s, rates: %s', self.order_type, gain,
-                                      path, self.arb_opps[path])
+                    if debug:
+                        path = curr1_quote.pair + '>' + curr2_curr1.pair + '>' + quote_curr2.pair
+                        self.logger.debug('%s orders, gain: %s, path: %s, rates: %s', self.order_type, gain,
+                                          path, (curr1_quote, curr2_curr1, quote_curr2, gain))
 
                     if gain > max_gain:
-                        max_gain, max_path = gain, path
+                        max_gain, best_opp = gain, (curr1_quote, curr2_curr1, quote_curr2, gain)  # named tuple dto?
 
         if max_gain > 0:  # self.gain_min_limit:
+            pair1, pair2, pair3, _ = best_opp
+            max_path = pair1.pair + '>' + pair2.pair + '>' + pair3.pair
             self.logger.info('%s orders Arb opportunity, %s gain=%s, %s: %s>%s>%s',
                              self.order_type,
                              self.quote_curr,
                              max_gain, max_path,
-                             self.arb_opps[max_path][0].order_rate,
-                             self.arb_opps[max_path][1].order_rate,
-                             self.arb_opps[max_path][2].order_rate,
+                             pair1.order_rate,
+                             pair2.order_rate,
+                             pair3.order_rate,
                              )
 
-            self._signal_arbitrage(max_path, self.quote_curr)
+            self._signal_arbitrage(best_opp, self.quote_curr)
         else:
             self.logger.debug('%s orders, %s, No arb opportunities', self.order_type, self.quote_curr)
 
-    def _signal_arbitrage(self, arb_path, quote_curr):
+    def _build_triangles(self, tickers: Dict[str, Ticker]):
+        # loops quote_curr->curr1->curr2->quote_curr which have all three pairs traded on exchange,
+        # these change only when markets are listed or delisted, so not worth rechecking on every tick
+        calc = self.arb_calculator
+        self._markets = frozenset(tickers)
+        self._triangles = []
+        for curr1 in self._other_currencies:
+            if not calc.has_pair(curr1, self.quote_curr):
+                continue
+
+            legs = [(calc.leg_id(curr2, curr1), calc.leg_id(self.quote_curr, curr2))
+                    for curr2 in self._other_currencies
+                    if curr2 != curr1
+                    and calc.has_pair(curr2, curr1)
+                    and calc.has_pair(self.quote_curr, curr2)]
+            if legs:
+                self._triangles.append((calc.leg_id(curr1, self.quote_curr), legs))
+
+        self.logger.info('%s: %s arbitrage loops over %s markets', self.quote_curr,
+                         sum(len(legs) for _, legs in self._triangles), len(self._markets))
+
+    def _signal_arbitrage(self, arb_opp, quote_curr):
         # signal to trader, which does all the subsequent arb trading round trip
         if self._signal_handler:
-            pair1, pair2, pair3, gain = self.arb_opps[arb_path]
+            pair1, pair2, pair3, gain = arb_opp
             self._signal_handler(pair1, pair2, pair3, gain, self.order_type, quote_curr)
 
     def register_signal_handler(self,
@@ -135,59 +157,115 @@ class AbstractArbCalculator(abc.ABC):
     def __init__(self, fee: Decimal):
         self.fee = fee
         self.tickers: Dict[str, Ticker] = {}
+        self._names: Dict[Tuple[str, str], Tuple[str, str]] = {}  # pair names both ways, currencies don't change
+        # legs are numbered once, so loops are scanned by list index instead of hashing currency strings
+        self._legs: List[Tuple[str, str]] = []  # currencies of leg by leg id
+        self._leg_ids: Dict[Tuple[str, str], int] = {}
+        self._rates: List[PairAndRate] = []  # legs calculated off current tickers, by leg id
+
+    def leg_id(self, curr_a: str, curr_b: str) -> int:
+        leg_id = self._leg_ids.get((curr_a, curr_b))
+        if leg_id is None:
+            leg_id = self._leg_ids[(curr_a, curr_b)] = len(self._legs)
+            self._legs.append((curr_a, curr_b))
+            self._rates.append(None)
+        return leg_id
+
+    def get_leg(self, leg_id: int) -> PairAndRate:
+        # each leg is calculated once per tickers update, loops share legs, e.g. all quote_curr->curr2 ones
+        rate = self._rates[leg_id]
+        if rate is None:
+            rate = self._rates[leg_id] = self._calc_pair_and_rate(*self._legs[leg_id])
+        return rate
 
     @abc.abstractmethod
-    def get_pair_and_rate(self, curr_a: str, curr_b: str) -> PairAndRate:
+    def _calc_pair_and_rate(self, curr_a: str, curr_b: str) -> PairAndRate:
         pass
 
     def set_tickers(self, tickers: Dict[str, Ticker]):
-        self.tickers = tickers
+        if tickers is not self.tickers:  # same tickers set by another indicator sharing the calculator
+            self.tickers = tickers
+            self._rates = [None] * len(self._legs)
+
+    def has_pair(self, curr_a: str, curr_b: str) -> bool:
+        # pair is traded on exchange in either direction
+        pair_ab, pair_ba = self._pair_names(curr_a, curr_b)
+        return pair_ab in self.tickers or pair_ba in self.tickers
+
+    def _pair_names(self, curr_a: str, curr_b: str) -> Tuple[str, str]:
+        # e.g. (BTC_USD, USD_BTC), built once per currencies couple instead of concatenating on every call
+        names = self._names.get((curr_a, curr_b))
+        if names is None:
+            names = self._names[(curr_a, curr_b)] = (curr_a + '_' + curr_b, curr_b + '_' + curr_a)
+        return names
 
 
 class LimitOrderArbCalculator(AbstractArbCalculator):
     def __init__(self, fee: Decimal, rate_offset: Decimal):
         self.rate_offset = rate_offset
         super().__init__(fee)
+        # fee and offset multipliers are constant for the calculator lifetime, so precalculated once
+        self._buy_off = 1 + rate_offset
+        self._sell_off = 1 - rate_offset
+        self._buy_num = (1 - fee) / self._buy_off
+        self._sell_num = (1 - fee) * self._sell_off
 
-    def get_pair_and_rate(self, curr_a, curr_b):
+    def _calc_pair_and_rate(self, curr_a, curr_b):
         # both combinations where curr_a is base curr or quote are considered
         # we look for buying curr_a for curr_b (or the same is selling curr_b for curr_a)
-        pair_ab = curr_a + '_' + curr_b  # e.g. BTC_USD
-        pair_ba = curr_b + '_' + curr_a  # e.g. USD_BTC
+        pair_ab, pair_ba = self._pair_names(curr_a, curr_b)  # e.g. BTC_USD, USD_BTC
 
         # taking prices 0.05% higher than buy or lower than sell, offset inwards current spread,
         # for more likely order execution
-        if pair_ab in self.tickers:
+        ticker = self.tickers.get(pair_ab)
+        if ticker is not None:
             return PairAndRate(pair_ab,
-                               calc_rate=(1 - self.fee) / self.tickers[pair_ab].buy_price / (1 + self.rate_offset),
-                               order_rate=self.tickers[pair_ab].buy_price * (1 + self.rate_offset),
+                               calc_rate=self._buy_num / ticker.buy_price,
+                               order_rate=ticker.buy_price * self._buy_off,
                                side=OrderSide.BUY)
-        elif pair_ba in self.tickers:
+
+        ticker = self.tickers.get(pair_ba)
+        if ticker is not None:
             return PairAndRate(pair_ba,
-                               calc_rate=(1 - self.fee) * self.tickers[pair_ba].sell_price * (1 - self.rate_offset),
-                               order_rate=self.tickers[pair_ba].sell_price * (1 - self.rate_offset),
+                               calc_rate=self._sell_num * ticker.sell_price,
+                               order_rate=ticker.sell_price * self._sell_off,
                                side=OrderSide.SELL)
-        else:
-            return None  # no such pair on exchange
+
+        return None  # no such pair on exchange
 
 
 class MarketOrderArbCalculator(AbstractArbCalculator):
+    def __init__(self, fee: Decimal):
+        super().__init__(fee)
+        self._fee_mult = 1 - fee  # constant for the calculator lifetime
 
-    def get_pair_and_rate(self, curr_a, curr_b):
+    def _calc_pair_and_rate(self, curr_a, curr_b):
         # both combinations where curr_a is base curr or quote_curr are considered
         # we look for buying curr_a for curr_b (or selling curr_b for curr_a),
         # in a market order we buy effectively at sell_price (and sell at buy_price), on the opposite side of spread
-        pair_ab = curr_a + '_' + curr_b  # e.g. BTC_USD
-        pair_ba = curr_b + '_' + curr_a  # e.g. USD_BTC
-        if pair_ab in self.tickers:
+        pair_ab, pair_ba = self._pair_names(curr_a, curr_b)  # e.g. BTC_USD, USD_BTC
+        ticker = self.tickers.get(pair_ab)
+        if ticker is not None:
             return PairAndRate(pair_ab,
-                               calc_rate=(1 - self.fee) / self.tickers[pair_ab].sell_price,
-                               order_rate=self.tickers[pair_ab].sell_price,
+                               calc_rate=self._fee_mult / ticker.sell_price,
+                               order_rate=ticker.sell_price,
                                side=OrderSide.BUY)
-        elif pair_ba in self.tickers:
+
+        ticker = self.tickers.get(pair_ba)
+        if ticker is not None:
             return PairAndRate(pair_ba,
-                               calc_rate=(1 - self.fee) * self.tickers[pair_ba].buy_price,
-                               order_rate=self.tickers[pair_ba].buy_price,
+                               calc_rate=self._fee_mult * ticker.buy_price,
+                               order_rate=ticker.buy_price,
                                side=OrderSide.SELL)
-        else:
-            return None
+
+        return None
+
+
+def get_fee_type(order_type: OrderType) -> str:
+    return 'maker' if order_type is OrderType.MARKET else 'taker'
+
+
+def make_arb_calculator(order_type: OrderType, fees: Dict[str, Decimal]) -> AbstractArbCalculator:
+    fee = fees[get_fee_type(order_type)]
+    return MarketOrderArbCalculator(fee) if order_type is OrderType.MARKET \
+        else LimitOrderArbCalculator(fee, Decimal('0.0005'))
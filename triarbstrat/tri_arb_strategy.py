@@ -8,15 +8,24 @@ Donate ETH: 0xFA745708C435300058278631429cA910AE175d52
 Donate BTC: 16KqCc4zxEWf7CaerWNZdGYwyuU33qDzCv
 """
 
+import atexit
 import logging
 from decimal import Decimal
-from typing import Dict
+from typing import Dict, Iterator, Tuple, Iterable
 import sqlite3
 from datetime import datetime
 import pathlib
+import time
+import queue
+import threading
+import itertools
+from itertools import accumulate
+from operator import itemgetter
+from contextlib import closing
 from exchanges.exmo_exchange import ExmoExchange, Ticker
-from triarbstrat.tri_arb_indicator import TriangularArbitrageIndicator
-from triarbstrat.tri_arb_trader import TriangularArbitrageTrader, PairAndRate, Order, OrderStatus, OrderType, OrderSide
+from triarbstrat.tri_arb_indicator import TriangularArbitrageIndicator, make_arb_calculator
+from triarbstrat.tri_arb_trader import TriangularArbitrageTrader, make_trader, PairAndRate, Order, OrderStatus, \
+    OrderType, OrderSide
 
 # TODO refactor, extract config to ext store
 QUOTE_CURRS = ['USD', 'EUR', 'RUB', 'BTC', 'ETH', 'LTC', 'XRP', 'USDT', 'DASH']
@@ -30,11 +39,19 @@ GAIN_MIN_LIMIT = Decimal('1.0')  # min gain for checking arbitrage round trip
 PNL_MIN_LIMIT = 1.0  # min PnL with slippage for starting arbitrage round trip - $0.50
 TICKERS_TO_SKIP = 30  # count of ticker requests to skip, while polling, saving space in DB for tickers
 POLLING_INTERVAL = 2  # polling exchange for ticker, in seconds
+TICKERS_BATCH_SIZE = 500  # count of ticker rows buffered before writing them to DB in one transaction
 
 MARKET_DATA_DB = './db/market_data.db'
 TRIARB_DATA_DB = './db/triarb_data.db'
 pathlib.Path('./db').mkdir(parents=True, exist_ok=True)
 
+# WAL with NORMAL sync doesn't fsync on every autocommitted statement, only on checkpoints
+SQLITE_PRAGMAS = """PRAGMA journal_mode=WAL;
+                    PRAGMA synchronous=NORMAL;
+                    PRAGMA temp_store=MEMORY;
+                    PRAGMA cache_size=-65536;
+                 """
+
 MARKET_DATA_DDL = """CREATE TABLE IF NOT EXISTS ticker (
                     pair VARCHAR  NOT NULL,
                     created TIMESTAMP NOT NULL,
@@ -87,14 +104,13 @@ TRIARB_DATA_DDL = """CREATE TABLE IF NOT EXISTS triarb_opportunity (
                );                
             """
 TD_OPP_INSERT = """INSERT INTO triarb_opportunity (
-                        pair1, calc_rate1, order_rate1, pair2, calc_rate2, order_rate2, pair3, calc_rate3, 
+                        id, pair1, calc_rate1, order_rate1, pair2, calc_rate2, order_rate2, pair3, calc_rate3, 
                         order_rate3, gain, order_type, created)
-                   VALUES(:pair1, :calc_rate1, :order_rate1, :pair2, :calc_rate2, :order_rate2, :pair3, :calc_rate3, 
-                          :order_rate3, :gain, :order_type, :created); """
+                   VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?); """
 
-TD_ORDER_INSERT = """INSERT INTO triarb_order (exch_order_id, triarb_opportunity_id, created, pair,
+TD_ORDER_INSERT = """INSERT INTO triarb_order (id, exch_order_id, triarb_opportunity_id, created, pair,
                                                quantity, price, side, type, status)
-                     VALUES(:exch_order_id, :triarb_opportunity_id, :created, :pair,
+                     VALUES(:id, :exch_order_id, :triarb_opportunity_id, :created, :pair,
                             :quantity, :price, :side, :type, :status); """
 TD_ORDER_UPDATE = """UPDATE triarb_order 
                      SET exch_order_id = :exch_order_id, 
@@ -115,20 +131,35 @@ class TriangularArbitrageStrategy:
         self.exchange = exchange
         self.logger = logger.getChild('tri_arb') if logger else logging.getLogger(__name__)
 
-        # Indicators needed on per quote currency basis, can be started as many indicators as currencies to watch
+        # Indicators needed on per quote currency basis, can be started as many indicators as currencies to watch,
+        # they all share one calculator, so rates of legs common to their loops are calculated once per update
         self.indicators = []
         currencies = exchange.get_currencies()
+        fees = exchange.get_fees()
+        arb_calculator = make_arb_calculator(ORDER_TYPE, fees)
         for quote_curr in QUOTE_CURRS:
-            self.indicators.append(TriangularArbitrageIndicator(quote_curr, currencies, exchange.get_fees(),
-                                                                ORDER_TYPE, GAIN_MIN_LIMIT, logger))
+            self.indicators.append(TriangularArbitrageIndicator(quote_curr, currencies, fees,
+                                                                ORDER_TYPE, GAIN_MIN_LIMIT, logger, arb_calculator))
 
         # TODO trader needed only to process round, upon opportunity accepted,
         # init in oppo_signal_handler, delete upon finish round
-        self.trader = TriangularArbitrageTrader(PAPER_TRADING, ORDER_TYPE, exchange, logger)
+        self.trader: TriangularArbitrageTrader = make_trader(PAPER_TRADING, ORDER_TYPE, exchange, logger)
         self._i: int = 0  # counter just to track tickers to skip
+        self._tick_time: datetime = None  # when current tickers were received, stamped on what is derived from them
+        self._tick_ns: int = 0  # the same in monotonic time, to measure age of opportunities
+        self._taker_fee_mult: float = 1 - float(fees['taker'])  # fees are fixed on exchange, applied to slippage
+
+        # tickers, opportunities and orders are written to DB by a separate thread, off the polling loop
+        self._db_queue = queue.Queue()
+        self._db_writer = threading.Thread(target=self._db_writer_loop, name='TriArbDbWriter', daemon=True)
+        self._opp_ids: Iterator[int] = None  # opportunity and order ids are assigned here, not waiting for insert
+        self._order_ids: Iterator[int] = None
 
     def start(self):
         self._init_db()
+        self._db_writer.start()
+        # buffered tickers and queued orders are flushed on interpreter exit too, if shutdown is skipped
+        atexit.register(self._stop_db_writer)
         for indicator in self.indicators:
             indicator.register_signal_handler(self.triarb_signal_handler)
         self.trader.register_order_update_handler(self.order_update_handler)
@@ -136,6 +167,8 @@ class TriangularArbitrageStrategy:
     def update(self):
         if not self.trader.is_loop_in_progress():
             tickers = self.exchange.get_ticker()
+            self._tick_time = datetime.now()
+            self._tick_ns = time.monotonic_ns()
 
             self._i += 1
             if self._i % TICKERS_TO_SKIP == 0:
@@ -158,7 +191,7 @@ class TriangularArbitrageStrategy:
         # should we do it here not in trader?
         trading_amount = TRADING_AMOUNTS[quote_curr]
 
-        if ORDER_TYPE == OrderType.MARKET:
+        if ORDER_TYPE is OrderType.MARKET:
             gain_with_slip, gain_with_slip_amount = self._recalc_gain_with_slippage(pair1, pair2, pair3, trading_amount)
             if gain_with_slip_amount < PNL_MIN_LIMIT:
                 self.logger.info('Gain with slippage: %s is too small, ignoring opportunity, PnL: %s %s',
@@ -166,11 +199,11 @@ class TriangularArbitrageStrategy:
                 return
             self.logger.info("Gain with slippage: %s, PnL: %s", gain_with_slip, gain_with_slip_amount)
 
-        self.trader.start_arb_loop(pair1, pair2, pair3, triarb_opp_id, trading_amount)
+        self.trader.start_arb_loop(pair1, pair2, pair3, triarb_opp_id, trading_amount, self._tick_ns)
 
     def _recalc_gain_with_slippage(self, pair1, pair2, pair3, trading_amount):
-        # get order book by each pair, depth 30 is enough?
-        order_book = self.exchange.get_order_book("%s,%s,%s" % (pair1.pair, pair2.pair, pair3.pair), DEPTH)
+        # get order book by each pair in one request, depth 30 is enough?
+        order_book = self.exchange.get_order_book_batch((pair1.pair, pair2.pair, pair3.pair), DEPTH)
 
         p1_order_book = order_book[pair1.pair]
         p2_order_book = order_book[pair2.pair]
@@ -188,58 +221,12 @@ class TriangularArbitrageStrategy:
 
         return gain, gain_amount
 
-    def _get_weighted_rate(self, amount_to_sell, order_book, side: OrderSide):
-        quantity_total = Decimal('0')
-        amount_total = Decimal('0')
-        last_rate = Decimal('0')
-
-        if side == OrderSide.BUY:  # buying curr_a in pair
-            sell_orders = order_book['ask']  # list of sell orders, we buy at this side of order book
-            for ask in sell_orders:
-                last_rate = Decimal(ask[0])
-                quantity_total += Decimal(ask[1])  # field is: price, quantity and amount, price -> ask[0]
-                amount_total += Decimal(ask[2])
-                # count until amount to sell is spent, that's how deep the order will slip
-                if amount_total >= amount_to_sell:
-                    break
-
-            if amount_total < amount_to_sell:
-                msg = "Not enough depth: {} for the whole amount to sell: {}. Increase DEPTH."\
-                    .format(DEPTH, amount_to_sell)
-                raise Exception(msg, DEPTH, amount_to_sell)
-                # TODO think how to avoid exceptions and gracefully just skip this opportunity, what to return?
-
-            # adjust quantity and amount to required amount_to_sell
-            if amount_total > amount_to_sell:
-                quantity_total = quantity_total - ((amount_total - amount_to_sell) / last_rate)
-                amount_total = amount_to_sell
-
-        else:  # selling curr_a in pair, acquiring curr_b
-            buy_orders = order_book['bid']  # list of buy orders, we sell at this side of order book
-            for bid in buy_orders:
-                last_rate = Decimal(bid[0])
-                quantity_total += Decimal(bid[1])  # field is: price, quantity and amount, price -> ask[0]
-                amount_total += Decimal(bid[2])
-                # count until acquired amount is sold as quantity, that how deep the order will slip
-                if quantity_total >= amount_to_sell:
-                    break
-
-            if quantity_total < amount_to_sell:
-                msg = "Not enough depth {} for the whole amount to sell: {}. Increase DEPTH."\
-                    .format(DEPTH, amount_to_sell)
-                raise Exception(msg, DEPTH, amount_to_sell)
-
-            # adjust quantity and amount to required amount_to_sell
-            if quantity_total > amount_to_sell:
-                amount_total = amount_total - ((quantity_total - amount_to_sell) * last_rate)
-                quantity_total = amount_to_sell
-
-        fee = (1 - self.exchange.get_fees()['taker'])
-        weighted_rate = fee * quantity_total / amount_total if side == OrderSide.BUY else \
-            fee * amount_total / quantity_total
-        acquired_amount = quantity_total if side == OrderSide.BUY else amount_total
-
-        return weighted_rate, acquired_amount
+    def _get_weighted_rate(self, amount_to_sell: Decimal, order_book, side: OrderSide) -> Tuple[Decimal, Decimal]:
+        # it's an estimation checked against PnL threshold, not amounts sent to exchange, so book is summed up in
+        # float which is plenty precise for that and way cheaper than Decimal, converted back at return
+        weighted_rate, acquired_amount = WEIGHTED_RATE_BY_SIDE[side](float(amount_to_sell), order_book,
+                                                                     self._taker_fee_mult)
+        return Decimal(repr(weighted_rate)), Decimal(repr(acquired_amount))
 
     def order_update_handler(self, order: Order) -> Order:
         # persist triarb condition/opportunity at which trader round trip initiated, for stats and analysis
@@ -247,60 +234,156 @@ class TriangularArbitrageStrategy:
         # TODO should we track orders here? not in trader?
 
     def _persist_tickers(self, tickers: Dict[str, Ticker]):
-        values = []
-        for key in tickers:
-            values.append((key, datetime.now()) + tickers[key])
-        self.sqlite_market.executemany(MD_TICKER_INSERT, values)
+        # rows are generated lazily by the writer thread when buffering them, tickers of a tick are not mutated after
+        now = self._tick_time
+        self._db_queue.put((MD_TICKER_INSERT, ((key, now, *ticker) for key, ticker in tickers.items())))
 
     def _persist_triarb_opportunity(self, pair1: PairAndRate, pair2: PairAndRate, pair3: PairAndRate, gain: Decimal,
                                     order_type: OrderType) -> int:
-        values = {}
-        for k, v in pair1._asdict().items():
-            values[k + '1'] = v
-        for k, v in pair2._asdict().items():
-            values[k + '2'] = v
-        for k, v in pair3._asdict().items():
-            values[k + '3'] = v
-        values['gain'] = gain
-        values['order_type'] = str(order_type)
-        values['created'] = datetime.now()
-
-        cursor = self.sqlite_triarb.cursor()
-        cursor.execute(TD_OPP_INSERT, values)
-        return cursor.lastrowid
+        opp_id = next(self._opp_ids)
+        values = (opp_id, *pair1.as_db_row(), *pair2.as_db_row(), *pair3.as_db_row(),
+                  gain, str(order_type), self._tick_time)
+
+        self._db_queue.put((TD_OPP_INSERT, values))
+        return opp_id
 
     def _persist_order(self, order: Order) -> Order:
-        values = order._asdict()
-        values['side'] = str(order.side)
-        values['type'] = str(order.type)
-        values['status'] = str(order.status)
-
-        if order.status == OrderStatus.PLACING:
-            cursor = self.sqlite_triarb.cursor()
-            cursor.execute(TD_ORDER_INSERT, values)
-            return order._replace(id=cursor.lastrowid)
+        if order.status is OrderStatus.PLACING:
+            order.id = next(self._order_ids)
+            values = {'id': order.id, 'exch_order_id': order.exch_order_id,
+                      'triarb_opportunity_id': order.triarb_opportunity_id,
+                      'created': datetime.fromtimestamp(order.created_ns / 1e9),
+                      'pair': order.pair, 'quantity': order.quantity, 'price': order.price,
+                      'side': str(order.side), 'type': str(order.type), 'status': str(order.status)}
+            self._db_queue.put((TD_ORDER_INSERT, values))
         else:
-            self.sqlite_triarb.execute(TD_ORDER_UPDATE, values)
-            return order
+            # values are taken now, order is updated in place by trader meanwhile it's waiting in queue
+            values = {'id': order.id, 'exch_order_id': order.exch_order_id, 'status': str(order.status)}
+            self._db_queue.put((TD_ORDER_UPDATE, values))
+        return order
 
     def shutdown(self):
         # stop running strategy, finish round, cancel unfilled orders etc
-        self.sqlite_market.commit()
-        self.sqlite_triarb.commit()
-        self.sqlite_market.close()
-        self.sqlite_triarb.close()
+        self._stop_db_writer()
+        atexit.unregister(self._stop_db_writer)
         for indicator in self.indicators:
             indicator.unregister_signal_handler(self.triarb_signal_handler)
         self.trader.unregister_order_update_handler(self.order_update_handler)
 
+    def _stop_db_writer(self):
+        if self._db_writer.is_alive():
+            self._db_queue.put(None)  # writer flushes what is left and stops
+            self._db_writer.join()
+
     def _init_db(self):
-        self.sqlite_market = sqlite3.connect(MARKET_DATA_DB, isolation_level=None,
-                                             detect_types=sqlite3.PARSE_DECLTYPES)
-        self.sqlite_triarb = sqlite3.connect(TRIARB_DATA_DB, isolation_level=None,
-                                             detect_types=sqlite3.PARSE_DECLTYPES)
+        # tables are created upfront, sqlite connections can't be shared between threads,
+        # so db writer opens its own ones
+        with closing(connect_db(MARKET_DATA_DB)) as sqlite_market:
+            sqlite_market.executescript(MARKET_DATA_DDL)
+        with closing(connect_db(TRIARB_DATA_DB)) as sqlite_triarb:
+            sqlite_triarb.executescript(TRIARB_DATA_DDL)
+            last_opp_id = sqlite_triarb.execute('SELECT max(id) FROM triarb_opportunity').fetchone()[0]
+            last_order_id = sqlite_triarb.execute('SELECT max(id) FROM triarb_order').fetchone()[0]
+
+        self._opp_ids = itertools.count((last_opp_id or 0) + 1)
+        self._order_ids = itertools.count((last_order_id or 0) + 1)
+
+    def _db_writer_loop(self):
+        sqlite_market = connect_db(MARKET_DATA_DB)
+        sqlite_triarb = connect_db(TRIARB_DATA_DB)
+        tickers_buffer = []
+
+        while True:
+            item = self._db_queue.get()
+            try:
+                if item is None or item[0] == MD_TICKER_INSERT:
+                    if item:
+                        tickers_buffer.extend(item[1])
+                    if tickers_buffer and (item is None or len(tickers_buffer) >= TICKERS_BATCH_SIZE):
+                        # batch is taken off buffer upfront, so a failing one is dropped, not retried forever
+                        rows, tickers_buffer = tickers_buffer, []
+                        # connection is in autocommit mode, explicit transaction makes one commit for whole batch
+                        with sqlite_market:
+                            sqlite_market.execute('BEGIN')
+                            sqlite_market.executemany(MD_TICKER_INSERT, rows)
+                else:
+                    sqlite_triarb.execute(*item)
+            except Exception as e:
+                # any error is logged and writer goes on, otherwise everything queued later would be lost silently
+                self.logger.error('Error writing to DB: %s', e, exc_info=1)
+
+            if item is None:
+                break
+
+        sqlite_market.close()
+        sqlite_triarb.close()
+
+
+def fill_depth(totals: Iterable[float], target: float) -> Tuple[int, float]:
+    """
+    Finds how deep into order book an order of the given size fills, like searchsorted over cumulative sum,
+    but running totals are calculated lazily only until the target is reached
+    :param totals: quantities or amounts of order book rows, top down
+    :param target: quantity or amount to fill
+    :return: index of the last row needed and cumulative total up to it,
+             total is less than target if book is too shallow
+    """
+    depth, total = -1, 0.0
+    for depth, total in enumerate(accumulate(totals)):
+        if total >= target:
+            break
+    return depth, total
+
+
+def weighted_buy(to_sell: float, order_book, fee_mult: float) -> Tuple[float, float]:
+    # buying curr_a in pair, returns weighted rate and acquired quantity of curr_a
+    sell_orders = order_book['ask']  # list of sell orders, we buy at this side of order book
+    # field is: price, quantity and amount, price -> ask[0]
+    # count until amount to sell is spent, that's how deep the order will slip
+    depth, amount_total = fill_depth(map(float, map(itemgetter(2), sell_orders)), to_sell)
+    quantity_total = sum(map(float, map(itemgetter(1), sell_orders[:depth + 1])))
+
+    if amount_total < to_sell:
+        msg = "Not enough depth: {} for the whole amount to sell: {}. Increase DEPTH.".format(DEPTH, to_sell)
+        raise Exception(msg, DEPTH, to_sell)
+        # TODO think how to avoid exceptions and gracefully just skip this opportunity, what to return?
+
+    # adjust quantity and amount to required amount_to_sell
+    if amount_total > to_sell:
+        last_rate = float(sell_orders[depth][0])
+        quantity_total = quantity_total - ((amount_total - to_sell) / last_rate)
+        amount_total = to_sell
+
+    return fee_mult * quantity_total / amount_total, quantity_total
+
+
+def weighted_sell(to_sell: float, order_book, fee_mult: float) -> Tuple[float, float]:
+    # selling curr_a in pair, acquiring curr_b, returns weighted rate and acquired amount of curr_b
+    buy_orders = order_book['bid']  # list of buy orders, we sell at this side of order book
+    # count until acquired amount is sold as quantity, that how deep the order will slip
+    depth, quantity_total = fill_depth(map(float, map(itemgetter(1), buy_orders)), to_sell)
+    amount_total = sum(map(float, map(itemgetter(2), buy_orders[:depth + 1])))
+
+    if quantity_total < to_sell:
+        msg = "Not enough depth {} for the whole amount to sell: {}. Increase DEPTH.".format(DEPTH, to_sell)
+        raise Exception(msg, DEPTH, to_sell)
+
+    # adjust quantity and amount to required amount_to_sell
+    if quantity_total > to_sell:
+        last_rate = float(buy_orders[depth][0])
+        amount_total = amount_total - ((quantity_total - to_sell) * last_rate)
+        quantity_total = to_sell
+
+    return fee_mult * amount_total / quantity_total, amount_total
+
+
+WEIGHTED_RATE_BY_SIDE = {OrderSide.BUY: weighted_buy, OrderSide.SELL: weighted_sell}
+
 
-        self.sqlite_market.executescript(MARKET_DATA_DDL)
-        self.sqlite_triarb.executescript(TRIARB_DATA_DDL)
+def connect_db(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES)
+    connection.executescript(SQLITE_PRAGMAS)
+    return connection
 
 
 def register_sqlite_adapters_and_converters():
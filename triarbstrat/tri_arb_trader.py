@@ -8,13 +8,19 @@ Donate ETH: 0xFA745708C435300058278631429cA910AE175d52
 Donate BTC: 16KqCc4zxEWf7CaerWNZdGYwyuU33qDzCv
 """
 
+import abc
 import logging
-from datetime import datetime
+import time
+from dataclasses import dataclass
 from enum import Enum
-from typing import NamedTuple, Callable, Iterator
+from typing import NamedTuple, Callable, Tuple, Dict
 from decimal import Decimal
+from exchange_apis.exmo_api import ExmoError
 from exchanges.exmo_exchange import ExmoExchange
 
+MAX_OPPORTUNITY_AGE_MS = 1000  # opportunity found on tickers older than that is likely gone, round is not started
+LEG_TIMEOUT_MS = 60000  # order not executed within that is canceled and round is abandoned
+
 
 class OrderType(Enum):
     MARKET = 'Market'
@@ -53,12 +59,22 @@ class PairAndRate(NamedTuple):
     # side of the order
     side: OrderSide
 
+    def as_db_row(self) -> tuple:
+        # columns persisted per leg of arb opportunity: pair, calc_rate, order_rate
+        return self[:3]
+
+
+@dataclass
+class Order:
+    # mutable, status transitions of order update it in place instead of copying it,
+    # slots declared explicitly as dataclass(slots=True) needs python 3.10+, fields have no defaults to clash with
+    __slots__ = ('id', 'exch_order_id', 'triarb_opportunity_id', 'created_ns', 'pair', 'quantity', 'price', 'side',
+                 'type', 'status')
 
-class Order(NamedTuple):
     id: int
     exch_order_id: int
     triarb_opportunity_id: int
-    created: datetime
+    created_ns: int  # unix time in ns, cheaper to take than datetime when placing, converted when persisted
     pair: str
     quantity: Decimal
     price: Decimal
@@ -67,9 +83,10 @@ class Order(NamedTuple):
     status: OrderStatus
 
 
-class TriangularArbitrageTrader:
+class TriangularArbitrageTrader(abc.ABC):
     """
-    TODO should be split to limit and market order traders
+    Trades arbitrage round trip, leg by leg, placing next order once the previous one is executed.
+    Placing and tracking orders specific to order type is done by LimitOrderTrader and MarketOrderTrader.
     """
 
     def __init__(self, paper_trading: bool, order_type: OrderType, exchange: ExmoExchange, logger: logging.Logger):
@@ -78,23 +95,31 @@ class TriangularArbitrageTrader:
         self.exchange = exchange
         self.initial_amount = 0
         self.logger = logger if logger else logging.getLogger(__name__)
+        # amount landing on balance after taker fee, fees are fixed on exchange
+        self._taker_fee_mult: Decimal = 1 - exchange.get_fees()['taker']
+        if not paper_trading:
+            # orders go over already open connection, it's kept alive by tickers polling in between rounds
+            self.exchange.warmup_connection()
 
         self.order_update_handler: Callable[[Order], Order] = None
+        # exchange method placing order by side, all called with pair, quantity and rate
+        self._placers: Dict[OrderSide, Callable[[str, Decimal, Decimal], int]] = {}
 
         # self.tickers: Dict[str, Ticker] = {}
         # self.legs: List[PairAndRate] = []
-        self.pairs_iter: Iterator[PairAndRate]
+        self.pairs: Tuple[PairAndRate, ...] = ()  # legs of the round, current one is at cur_pair_idx - 1
         self.triarb_opp_id: int = 0
         # self.orders: List[Order] = []
 
         self.current_pair: PairAndRate = None
         self.cur_pair_idx: int = 0
         self.current_order: Order = None
+        self._placed_ns: int = 0  # monotonic time current order went open on exchange, to time out its leg
         self.current_acquired_curr: str = ''
         self.current_acquired_amount: Decimal = 0
 
     def start_arb_loop(self, pair1: PairAndRate, pair2: PairAndRate, pair3: PairAndRate, triarb_opp_id: int,
-                       trading_amount: Decimal):
+                       trading_amount: Decimal, opportunity_ns: int = None):
         # accepts signals only when all orders placed are filled and sequence finished or canceled
         # TODO pass initial_amount as trading amount here not in constructor
 
@@ -114,16 +139,24 @@ class TriangularArbitrageTrader:
         if self.paper_trading or self.current_order:
             return  # arb loop in progress
 
+        # opportunity_ns is monotonic time when tickers it was found on were received
+        if opportunity_ns is not None:
+            age_ms = (time.monotonic_ns() - opportunity_ns) / 1e6
+            if age_ms > MAX_OPPORTUNITY_AGE_MS:
+                self.logger.info('Opportunity is %.0f ms old, ignoring it', age_ms)
+                return
+
         self.initial_amount = trading_amount
         self.current_acquired_amount = trading_amount
+        self.current_acquired_curr = spent_currency(pair1)  # quote curr round starts with
 
-        self.pairs_iter = iter([pair1, pair2, pair3])
+        self.pairs = (pair1, pair2, pair3)
         self.triarb_opp_id = triarb_opp_id
 
         # First pair process: buy curr1 with quote_curr (or sell quote_curr for curr1)
-        self.current_pair = next(self.pairs_iter)   # switch leg
-        self.cur_pair_idx += 1
-        self.logger.info('Triarb sequence started: %s', (pair1.pair, pair2.pair, pair3.pair))
+        self.current_pair = pair1   # switch leg
+        self.cur_pair_idx = 1
+        self.logger.info('Triarb sequence started: %s>%s>%s', pair1.pair, pair2.pair, pair3.pair)
         self._place_order(self.current_pair, self.triarb_opp_id)
 
     def update(self):
@@ -132,16 +165,19 @@ class TriangularArbitrageTrader:
 
         # track order filling: check orders fill status, order filling trades prices - trace pair1 order
         # if no open orders or no order_id order open then it's completed
+        # next leg is placed and checked right after previous one completed, not waiting for next polling interval,
+        # so with market orders executed on placing the whole round goes within one update
         self._update_current_order_status()
 
-        if self.current_order and self.current_order.status == OrderStatus.COMPLETED:
+        while self.current_order and self.current_order.status is OrderStatus.COMPLETED:
             # Second: buy curr2 for curr1 (or sell curr1 for curr2)
             # Third: selling curr2 for quote curr... (or equivalent is buying our quote curr for curr2)
-            try:
-                self.current_pair = next(self.pairs_iter)
+            if self.cur_pair_idx < len(self.pairs):
+                self.current_pair = self.pairs[self.cur_pair_idx]
                 self.cur_pair_idx += 1
                 self._place_order(self.current_pair, self.triarb_opp_id)
-            except StopIteration:
+                self._update_current_order_status()
+            else:
                 self.logger.info('Triarb sequence finished')
                 self.current_order = None
                 self.cur_pair_idx = 0
@@ -150,6 +186,12 @@ class TriangularArbitrageTrader:
                 self.logger.info('Result of round: %s %s', pnl, self.current_acquired_curr)
                 # TODO persist result of round for stats
 
+        # limit order left behind by market moved away may never execute, round is not kept waiting for it forever
+        order = self.current_order
+        if order and order.status is OrderStatus.OPEN \
+                and time.monotonic_ns() - self._placed_ns > LEG_TIMEOUT_MS * 1000000:
+            self._cancel_round()
+
     def is_loop_in_progress(self):
         return self.current_order is not None
 
@@ -157,66 +199,91 @@ class TriangularArbitrageTrader:
         if self.paper_trading:
             return
 
-        if self.order_type == OrderType.LIMIT and pair.side == OrderSide.BUY:
-            quantity = self.current_acquired_amount / pair.order_rate
-        else:
-            quantity = self.current_acquired_amount
+        # fields read more than once are bound to locals, saving attribute lookups between legs
+        pair_name, order_rate, side = pair.pair, pair.order_rate, pair.side
+        quantity = self._order_quantity(pair)
 
-        self.current_order = Order(-1, -1, triarb_opp_id, datetime.now(), pair.pair, quantity,
-                                   pair.order_rate, pair.side, self.order_type, OrderStatus.PLACING)
+        self.current_order = Order(-1, -1, triarb_opp_id, time.time_ns(), pair_name, quantity,
+                                   order_rate, side, self.order_type, OrderStatus.PLACING)
         self._handle_order_update()  # persisted, updated with db id
 
-        if self.order_type == OrderType.LIMIT:
-            if pair.side == OrderSide.BUY:
-                exch_order_id = self.exchange.place_limit_buy(pair.pair, quantity, pair.order_rate)
-            else:
-                exch_order_id = self.exchange.place_limit_sell(pair.pair, quantity, pair.order_rate)
-        else:  # Market
-            if pair.side == OrderSide.BUY:
-                # rate is not needed as quantity is effectively an amount in buy_total order
-                exch_order_id = self.exchange.place_market_buy_total(pair.pair, quantity)
-            else:
-                exch_order_id = self.exchange.place_market_sell(pair.pair, quantity)
+        exch_order_id = self._placers[side](pair_name, quantity, order_rate)
         # TODO update order in case of error as well - status PLACING and error msg if occurred
 
-        self.current_order = self.current_order._replace(exch_order_id=exch_order_id, status=OrderStatus.OPEN)
+        order = self.current_order
+        order.exch_order_id = exch_order_id
+        order.status = OrderStatus.OPEN
+        self._placed_ns = time.monotonic_ns()
         self._handle_order_update()  # persisted, updated with exchange id
 
-        self.logger.info('Order placed for pair[%s] : %s', self.cur_pair_idx, pair.pair)
+        self.logger.info('Order placed for pair[%s] : %s', self.cur_pair_idx, pair_name)
 
     def _update_current_order_status(self):
-        if self.current_order and self.current_order.exch_order_id != -1:
-            open_orders = self.exchange.get_user_open_orders()
-            if open_orders and self.current_pair.pair in open_orders:
-                pair_orders = open_orders[self.current_pair.pair]  # list
-                for o in pair_orders:
-                    if int(o['order_id']) == self.current_order.exch_order_id:
-                        return  # order remains open
+        order = self.current_order
+        if order and order.exch_order_id != -1:
+            if self._is_order_open():
+                return  # order remains open
 
             # otherwise it's completed
             # or canceled, TODO need to track by order trades and partial filling, later
-            order_trades = self.exchange.get_order_trades(self.current_order.exch_order_id)
+            exch_order_id = order.exch_order_id
+            order_trades = self.exchange.get_order_trades(exch_order_id)
             if order_trades:
-                self.current_acquired_curr = order_trades['in_currency']
+                acquired_curr = self.current_acquired_curr = order_trades['in_currency']
                 # amount should be actual on balance, accounting for fees
                 # it turned out that exmo returns in_amount as of only per order, not deducting fees
                 # which obviously is different from actual amount landing on your balance
-                fee = self.exchange.get_fees()['taker']
-                self.current_acquired_amount = Decimal(order_trades['in_amount']) * (1 - fee)
-                self.logger.info('Order executed %s, acquired %s %s', self.current_order.exch_order_id,
-                                 self.current_acquired_amount, self.current_acquired_curr)
+                acquired_amount = self.current_acquired_amount = order_trades['in_amount'] * self._taker_fee_mult
+                self.logger.info('Order executed %s, acquired %s %s', exch_order_id, acquired_amount, acquired_curr)
 
-                self.current_order = self.current_order._replace(status=OrderStatus.COMPLETED)
+                order.status = OrderStatus.COMPLETED
                 self._handle_order_update()
             else:
                 self.logger.error('Something went wrong on exchange, order executed but no trades found, order %s',
-                                  self.current_order.exch_order_id)
-                raise Exception('Error: order executed but no trades found', self.current_order.exch_order_id)
+                                  exch_order_id)
+                raise Exception('Error: order executed but no trades found', exch_order_id)
 
         else:
             # clearing current order after error placing order, when exch_order_id = -1 remains not updated
             self.current_order = None
 
+    def _cancel_round(self):
+        # currency acquired by previous legs remains on balance
+        order = self.current_order
+        try:
+            self.exchange.cancel_order(order.exch_order_id)
+        except ExmoError as e:
+            # likely executed meanwhile, then it's picked up as completed on next update
+            self.logger.warning('Failed to cancel order %s: %s', order.exch_order_id, e)
+            return
+
+        order.status = OrderStatus.CANCELED
+        self._handle_order_update()
+        self.logger.warning('Order %s for pair[%s] : %s not executed in %s ms, canceled, triarb sequence abandoned '
+                            'holding %s %s', order.exch_order_id, self.cur_pair_idx, order.pair, LEG_TIMEOUT_MS,
+                            self.current_acquired_amount, self.current_acquired_curr)
+
+        # limit order could be partially filled before cancel, what it acquired lands on balance as well
+        try:
+            order_trades = self.exchange.get_order_trades(order.exch_order_id)
+        except ExmoError as e:
+            order_trades = None  # exchange reports an error for order without any trades
+            self.logger.debug('No trades for canceled order %s: %s', order.exch_order_id, e)
+        if order_trades:
+            self.logger.warning('Canceled order %s was partially filled, spent %s %s, acquired %s %s',
+                                order.exch_order_id, order_trades.get('out_amount'), order_trades.get('out_currency'),
+                                order_trades['in_amount'] * self._taker_fee_mult, order_trades['in_currency'])
+        self.current_order = None
+        self.cur_pair_idx = 0
+
+    @abc.abstractmethod
+    def _order_quantity(self, pair: PairAndRate) -> Decimal:
+        pass
+
+    @abc.abstractmethod
+    def _is_order_open(self) -> bool:
+        pass
+
     def _handle_order_update(self):
         if self.order_update_handler:
             self.current_order = self.order_update_handler(self.current_order)  # persisted, updated with db id
@@ -229,3 +296,56 @@ class TriangularArbitrageTrader:
     def unregister_order_update_handler(self, handler):
         if handler == self.order_update_handler:
             self.order_update_handler = None
+
+
+class LimitOrderTrader(TriangularArbitrageTrader):
+
+    def __init__(self, paper_trading: bool, exchange: ExmoExchange, logger: logging.Logger):
+        super().__init__(paper_trading, OrderType.LIMIT, exchange, logger)
+        self._placers = {OrderSide.BUY: exchange.place_limit_buy, OrderSide.SELL: exchange.place_limit_sell}
+
+    def _order_quantity(self, pair):
+        # buying, acquired amount is spent for quantity of base curr at order rate
+        if pair.side is OrderSide.BUY:
+            return self.current_acquired_amount / pair.order_rate
+        return self.current_acquired_amount
+
+    def _is_order_open(self):
+        open_orders = self.exchange.get_user_open_orders()
+        if open_orders and self.current_pair.pair in open_orders:
+            pair_orders = open_orders[self.current_pair.pair]  # list
+            for o in pair_orders:
+                if int(o['order_id']) == self.current_order.exch_order_id:
+                    return True
+        return False
+
+
+class MarketOrderTrader(TriangularArbitrageTrader):
+
+    def __init__(self, paper_trading: bool, exchange: ExmoExchange, logger: logging.Logger):
+        super().__init__(paper_trading, OrderType.MARKET, exchange, logger)
+        self._placers = {
+            # rate is not needed as quantity is effectively an amount in buy_total order
+            OrderSide.BUY: lambda pair, amount, _: exchange.place_market_buy_total(pair, amount),
+            OrderSide.SELL: lambda pair, quantity, _: exchange.place_market_sell(pair, quantity),
+        }
+
+    def _order_quantity(self, pair):
+        return self.current_acquired_amount
+
+    def _is_order_open(self):
+        # market orders are executed by exchange on placing, so asking for open orders is a wasted round trip,
+        # its trades are checked straight away
+        return False
+
+
+def spent_currency(pair: PairAndRate) -> str:
+    # currency given away by order on the pair, quote curr when buying, base curr when selling, e.g. USD for BTC_USD buy
+    base_curr, quote_curr = pair.pair.split('_')
+    return quote_curr if pair.side is OrderSide.BUY else base_curr
+
+
+def make_trader(paper_trading: bool, order_type: OrderType, exchange: ExmoExchange,
+                logger: logging.Logger) -> TriangularArbitrageTrader:
+    trader_class = LimitOrderTrader if order_type is OrderType.LIMIT else MarketOrderTrader
+    return trader_class(paper_trading, exchange, logger)